@@ -1,87 +1,295 @@
 import asyncio
 import hashlib
+import heapq
 import json
+import mmap
 import os
+import stat
+import struct
+import tempfile
 import time
-from typing import Dict, List, Optional, Tuple
+import zlib
+from array import array
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from kademlia.crawling import NodeSpiderCrawl
 from kademlia.network import Server
+from kademlia.protocol import KademliaProtocol
+from kademlia.routing import RoutingTable
 import aiofiles
 from dataclasses import dataclass
+from operator import itemgetter
 import logging
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-@dataclass
+# Los hashes de fragmentos se manejan como digest SHA-256 crudo (32 bytes);
+# solo se codifican en hexadecimal al publicarlos en JSON o en los logs
+HASH_SIZE = hashlib.sha256().digest_size
+
+# Máximo de operaciones DHT simultáneas al publicar fragmentos
+MAX_CONCURRENT_STORES = 32
+
+# Máximo de transferencias TCP de fragmentos simultáneas por nodo
+MAX_CONCURRENT_TRANSFERS = 8
+
+# Máximo de fragmentos descargados pendientes de procesar en una descarga
+MAX_IN_FLIGHT_FRAGMENTS = 32
+
+# Hilos dedicados a lectura y escritura de archivos en disco por nodo
+DISK_WORKERS = 4
+
+# Segundos durante los que se reutiliza la selección de vecinos más cercanos
+FRAGMENT_LOOKUP_CACHE_TTL = 10
+NEIGHBORS_CACHE_SIZE = 1024
+
+# Segundos de espera al ping de cada contacto de la tabla de rutas guardada;
+# si no responde ninguno se recurre a los nodos bootstrap
+SNAPSHOT_BOOTSTRAP_TIMEOUT = 1
+
+# Caché local de valores leídos de la DHT (file_info y metadatos de fragmentos)
+LOOKUP_CACHE_SIZE = 1024
+LOOKUP_CACHE_TTL = 60
+
+# Máximo de buffers por llamada a writev (IOV_MAX en Linux)
+IOV_MAX = 1024
+
+# Registro binario de metadatos de fragmento publicado en la DHT: cabecera
+# (puerto, índice, total de fragmentos, tamaño, longitud de node_id, longitud
+# de host) seguida de node_id, host y nombre de archivo en UTF-8
+FRAGMENT_INFO = struct.Struct('!HIIQHH')
+
+# Cabecera (longitud, comprimido) que precede a los datos de cada fragmento enviado por TCP
+FRAME_HEADER = struct.Struct('!I?')
+
+# Compresión de fragmentos: nivel rápido de zlib, y solo se conserva el
+# resultado comprimido si ahorra al menos un 5% del tamaño original
+COMPRESSION_LEVEL = 1
+COMPRESSION_MIN_RATIO = 0.95
+
+# Marca que se encola cuando todas las descargas de un archivo han terminado
+_DOWNLOADS_FINISHED = object()
+
+def _writev_all(fd: int, buffers: List[bytes]):
+    """Escribe todos los buffers en fd con escrituras agrupadas (writev)"""
+    views = [memoryview(buffer) for buffer in buffers if buffer]
+    start = 0
+    while start < len(views):
+        written = os.writev(fd, views[start:start + IOV_MAX])
+        # Descarta los buffers escritos por completo y recorta el parcial
+        while start < len(views) and written >= len(views[start]):
+            written -= len(views[start])
+            start += 1
+        if written:
+            views[start] = views[start][written:]
+
+def _write_buffers(output_file, buffers: List[bytes]):
+    """Escribe los buffers en un archivo abierto, con writev si está disponible"""
+    if hasattr(os, 'writev'):
+        _writev_all(output_file.fileno(), buffers)
+    else:
+        for buffer in buffers:
+            output_file.write(buffer)
+
+def _pwrite_all(fd: int, data: bytes, offset: int):
+    """Escribe data completo en fd a partir de offset"""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+def _output_file_mode(output_path: str) -> int:
+    """Permisos para el archivo descargado.
+    
+    Se conservan los del archivo que reemplaza o, si no existe, los que le
+    daría open() con la umask actual.
+    """
+    try:
+        return stat.S_IMODE(os.stat(output_path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def _pack_fragment_info(fragment_info: Dict) -> bytes:
+    """Codifica los metadatos de un fragmento en su registro binario"""
+    host, port = fragment_info['node_address']
+    node_id = fragment_info['node_id'].encode()
+    host = host.encode()
+    header = FRAGMENT_INFO.pack(
+        port,
+        fragment_info['index'],
+        fragment_info['total_fragments'],
+        fragment_info['size'],
+        len(node_id),
+        len(host)
+    )
+    return header + node_id + host + fragment_info['filename'].encode()
+
+def _unpack_fragment_info(blob: bytes) -> Dict:
+    """Decodifica el registro binario de metadatos de un fragmento"""
+    port, index, total_fragments, size, node_id_len, host_len = FRAGMENT_INFO.unpack_from(blob)
+    host_start = FRAGMENT_INFO.size + node_id_len
+    filename_start = host_start + host_len
+    return {
+        'node_id': blob[FRAGMENT_INFO.size:host_start].decode(),
+        'node_address': (blob[host_start:filename_start].decode(), port),
+        'filename': blob[filename_start:].decode(),
+        'index': index,
+        'total_fragments': total_fragments,
+        'size': size
+    }
+
+def _write_fragments(output_file, fragments: List['Fragment']):
+    """Escribe el contenido original de los fragmentos, en orden, en un archivo abierto"""
+    _write_buffers(output_file, [fragment.raw_data() for fragment in fragments])
+
+def _write_fragment_at(fd: int, fragment: 'Fragment', offsets: List[int]):
+    """Escribe el contenido original del fragmento en cada desplazamiento indicado"""
+    data = fragment.raw_data()
+    for offset in offsets:
+        _pwrite_all(fd, data, offset)
+
+@dataclass(slots=True)
 class Fragment:
     """Representa un fragmento de archivo"""
-    hash: str
+    hash: bytes
     size: int
     index: int
     total_fragments: int
     filename: str
     data: bytes = None
+    compressed: bool = False
+    
+    def raw_data(self) -> bytes:
+        """Devuelve los datos originales, descomprimiéndolos si es necesario.
+        
+        Lanza ValueError si no tienen el tamaño y el hash esperados.
+        """
+        if self.compressed:
+            # Se limita la salida a size + 1 bytes: un bloque comprimido que
+            # se expanda más allá de lo anunciado se rechaza sin descomprimirlo entero
+            try:
+                data = zlib.decompressobj().decompress(self.data, self.size + 1)
+            except zlib.error as e:
+                raise ValueError(f"Fragmento {self.hash[:4].hex()} corrupto: {e}") from e
+        else:
+            data = self.data
+        if len(data) != self.size or hashlib.sha256(data).digest() != self.hash:
+            raise ValueError(f"Fragmento {self.hash[:4].hex()} corrupto")
+        return data
 
 class FragmentManager:
     """Gestor de fragmentación y ensamblaje de archivos"""
     
     def __init__(self, fragment_size: int = 256 * 1024):  # 256KB por defecto
         self.fragment_size = fragment_size
-        self.fragments_cache: Dict[str, Fragment] = {}
+        # Caché de metadatos en columnas: una fila por fragmento en lugar de
+        # un objeto Fragment por entrada; los Fragment se construyen al consultar.
+        # Los datos no se guardan aquí: el nodo que almacena el fragmento los conserva
+        self._cache_rows: Dict[bytes, int] = {}
+        self._cache_sizes = array('Q')
+        self._cache_indices = array('I')
+        self._cache_totals = array('I')
+        self._cache_filenames: List[str] = []
     
-    def fragment_file(self, filepath: str) -> List[Fragment]:
-        """Divide un archivo en fragmentos"""
-        fragments = []
+    def _cache_fragment(self, fragment: Fragment):
+        """Registra un fragmento en la caché de metadatos"""
+        row = self._cache_rows.get(fragment.hash)
+        if row is None:
+            self._cache_rows[fragment.hash] = len(self._cache_sizes)
+            self._cache_sizes.append(fragment.size)
+            self._cache_indices.append(fragment.index)
+            self._cache_totals.append(fragment.total_fragments)
+            self._cache_filenames.append(fragment.filename)
+        else:
+            self._cache_sizes[row] = fragment.size
+            self._cache_indices[row] = fragment.index
+            self._cache_totals[row] = fragment.total_fragments
+            self._cache_filenames[row] = fragment.filename
+    
+    def fragment_file(self, filepath: str) -> Iterator[Fragment]:
+        """Divide un archivo en fragmentos, generándolos bajo demanda"""
         filename = os.path.basename(filepath)
+        file_size = os.stat(filepath).st_size
+        total_fragments = (file_size + self.fragment_size - 1) // self.fragment_size
         
-        with open(filepath, 'rb') as file:
-            file_data = file.read()
-            file_size = len(file_data)
-            total_fragments = (file_size + self.fragment_size - 1) // self.fragment_size
-            
-            for i in range(total_fragments):
-                start = i * self.fragment_size
-                end = min(start + self.fragment_size, file_size)
-                fragment_data = file_data[start:end]
-                
-                fragment_hash = hashlib.sha256(fragment_data).hexdigest()
-                
-                fragment = Fragment(
-                    hash=fragment_hash,
-                    size=len(fragment_data),
-                    index=i,
-                    total_fragments=total_fragments,
-                    filename=filename,
-                    data=fragment_data
-                )
-                
-                fragments.append(fragment)
-                self.fragments_cache[fragment_hash] = fragment
+        # mmap no admite archivos vacíos: no hay fragmentos que generar
+        if total_fragments:
+            # El archivo se mapea en memoria en lugar de leerse: el hash se
+            # calcula sobre la página mapeada y solo se copian los datos del fragmento
+            with open(filepath, 'rb') as file, \
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for i in range(total_fragments):
+                    start = i * self.fragment_size
+                    end = min(start + self.fragment_size, file_size)
+                    
+                    with memoryview(mapped)[start:end] as view:
+                        # El hash se calcula sobre el contenido sin comprimir
+                        fragment_hash = hashlib.sha256(view).digest()
+                        fragment_data = zlib.compress(view, COMPRESSION_LEVEL)
+                        compressed = len(fragment_data) < len(view) * COMPRESSION_MIN_RATIO
+                        if not compressed:
+                            fragment_data = bytes(view)
+                    
+                    fragment = Fragment(
+                        hash=fragment_hash,
+                        size=end - start,
+                        index=i,
+                        total_fragments=total_fragments,
+                        filename=filename,
+                        data=fragment_data,
+                        compressed=compressed
+                    )
+                    
+                    self._cache_fragment(fragment)
+                    yield fragment
         
         logger.info(f"Archivo {filename} fragmentado en {total_fragments} partes")
-        return fragments
     
-    def assemble_file(self, fragments: List[Fragment], output_path: str) -> bool:
-        """Ensambla fragmentos en un archivo completo"""
+    def assemble_file(self, fragments: List[Fragment], output_path: str,
+                      fragment_hashes: Optional[List[bytes]] = None) -> bool:
+        """Ensambla fragmentos en un archivo completo.
+        
+        fragment_hashes es el orden publicado en file_info: cada posición toma el
+        fragmento con ese hash, así un fragmento repetido en el archivo se escribe
+        en todas sus posiciones. Sin él se usa el índice de cada fragmento, que
+        solo es fiable para los generados localmente por fragment_file.
+        """
         if not fragments:
             return False
         
-        fragments.sort(key=lambda x: x.index)
+        if fragment_hashes is not None:
+            by_hash = {fragment.hash: fragment for fragment in fragments}
+            ordered: List[Optional[Fragment]] = [by_hash.get(h) for h in fragment_hashes]
+        else:
+            # Los índices son 0..N-1, así que cada fragmento se coloca
+            # directamente en su posición sin necesidad de ordenar
+            ordered = [None] * fragments[0].total_fragments
+            for fragment in fragments:
+                if 0 <= fragment.index < len(ordered):
+                    ordered[fragment.index] = fragment
         
-        expected_fragments = fragments[0].total_fragments
-        if len(fragments) != expected_fragments:
-            logger.error(f"Faltan fragmentos: {len(fragments)}/{expected_fragments}")
+        if None in ordered:
+            logger.error(f"Faltan fragmentos: {ordered.count(None)}/{len(ordered)}")
             return False
         
+        for position, fragment in enumerate(ordered):
+            if not fragment.data:
+                logger.error(f"Fragmento {position} sin datos")
+                return False
+        
         try:
             with open(output_path, 'wb') as output_file:
-                for fragment in fragments:
-                    if fragment.data:
-                        output_file.write(fragment.data)
-                    else:
-                        logger.error(f"Fragmento {fragment.index} sin datos")
-                        return False
+                _write_fragments(output_file, ordered)
             
             logger.info(f"Archivo ensamblado exitosamente en {output_path}")
             return True
@@ -89,9 +297,130 @@ class FragmentManager:
             logger.error(f"Error ensamblando archivo: {e}")
             return False
     
-    def get_fragment_info(self, fragment_hash: str) -> Optional[Fragment]:
-        """Obtiene información de un fragmento por su hash"""
-        return self.fragments_cache.get(fragment_hash)
+    def get_fragment_info(self, fragment_hash: bytes) -> Optional[Fragment]:
+        """Obtiene los metadatos (sin datos) de un fragmento por su hash"""
+        row = self._cache_rows.get(fragment_hash)
+        if row is None:
+            return None
+        return Fragment(
+            hash=fragment_hash,
+            size=self._cache_sizes[row],
+            index=self._cache_indices[row],
+            total_fragments=self._cache_totals[row],
+            filename=self._cache_filenames[row]
+        )
+
+class TTLCache:
+    """Caché LRU de tamaño acotado cuyas entradas expiran tras ttl segundos"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+    
+    def get(self, key):
+        """Devuelve el valor vigente para key, o None si no existe o expiró"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        """Guarda value para key, descartando la entrada menos usada si está llena"""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+class BoundedRoutingTable(RoutingTable):
+    """Tabla de rutas que elige los k vecinos más cercanos con un heap acotado"""
+    
+    def __init__(self, protocol, ksize, node):
+        super().__init__(protocol, ksize, node)
+        self._neighbors_cache: Dict[Tuple, Tuple[float, List]] = {}
+        # Instantánea plana (long_id, nodo) de los contactos, reconstruida
+        # solo cuando cambia la tabla
+        self._contacts: Optional[List[Tuple[int, object]]] = None
+    
+    def _invalidate(self):
+        self._neighbors_cache.clear()
+        self._contacts = None
+    
+    def add_contact(self, node):
+        self._invalidate()
+        super().add_contact(node)
+    
+    def remove_contact(self, node):
+        self._invalidate()
+        super().remove_contact(node)
+    
+    def _contact_ids(self) -> List[Tuple[int, object]]:
+        """Devuelve la instantánea de contactos, construyéndola si es necesario"""
+        if self._contacts is None:
+            self._contacts = [
+                (neighbor.long_id, neighbor)
+                for bucket in self.buckets
+                for neighbor in bucket.get_nodes()
+            ]
+        return self._contacts
+    
+    def find_neighbors(self, node, k=None, exclude=None):
+        """Devuelve los k contactos más cercanos a node por distancia XOR"""
+        k = k or self.ksize
+        key = (node.id, k, exclude.ip if exclude else None, exclude.port if exclude else None)
+        now = time.monotonic()
+        cached = self._neighbors_cache.get(key)
+        if cached and cached[0] > now:
+            return list(cached[1])
+        
+        # heapq.nsmallest mantiene solo k candidatos: O(n log k) sobre todos
+        # los contactos en vez de detenerse en los primeros k recorridos.
+        # La distancia es un único XOR de enteros sobre los ids precalculados
+        target = node.long_id
+        candidates = (
+            (long_id ^ target, neighbor)
+            for long_id, neighbor in self._contact_ids()
+            if long_id != target and (exclude is None or not neighbor.same_home_as(exclude))
+        )
+        neighbors = [neighbor for _, neighbor in heapq.nsmallest(k, candidates, key=itemgetter(0))]
+        if len(self._neighbors_cache) >= NEIGHBORS_CACHE_SIZE:
+            self._neighbors_cache.clear()
+        self._neighbors_cache[key] = (now + FRAGMENT_LOOKUP_CACHE_TTL, neighbors)
+        return list(neighbors)
+
+class BoundedKademliaProtocol(KademliaProtocol):
+    """Protocolo Kademlia que usa BoundedRoutingTable como tabla de rutas"""
+    
+    def __init__(self, source_node, storage, ksize):
+        super().__init__(source_node, storage, ksize)
+        self.router = BoundedRoutingTable(self, ksize, source_node)
+    
+    # rpcudp no contempla que quien espera una respuesta cancele su petición:
+    # al llegar la respuesta o vencer el plazo intentaría resolver un futuro
+    # ya cancelado. Esas peticiones se descartan sin más
+    def _accept_response(self, msg_id, data, address):
+        if msg_id in self._outstanding:
+            future, timeout = self._outstanding[msg_id]
+            if future.cancelled():
+                timeout.cancel()
+                del self._outstanding[msg_id]
+                return
+        super()._accept_response(msg_id, data, address)
+    
+    def _timeout(self, msg_id):
+        if self._outstanding[msg_id][0].cancelled():
+            del self._outstanding[msg_id]
+            return
+        super()._timeout(msg_id)
+
+class P2PServer(Server):
+    """Servidor Kademlia con selección acotada y cacheada de vecinos"""
+    protocol_class = BoundedKademliaProtocol
 
 class P2PNode:
     """Nodo P2P principal"""
@@ -99,13 +428,74 @@ class P2PNode:
     def __init__(self, node_id: str, port: int):
         self.node_id = node_id
         self.port = port
-        self.server = Server()
+        self.server = P2PServer()
         self.fragment_manager = FragmentManager()
         self.active_downloads: Dict[str, Dict] = {}
-        self.stored_fragments: Dict[str, Fragment] = {}
-        self.file_registry: Dict[str, List[str]] = {}
+        self.stored_fragments: Dict[bytes, Fragment] = {}
+        self.file_registry: Dict[str, List[bytes]] = {}
         self.running = False
         self.tcp_server = None
+        self.transfer_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
+        self.disk_executor = ThreadPoolExecutor(max_workers=DISK_WORKERS)
+        self.routing_snapshot_path = f"{node_id}.rt.json"
+        self.snapshot_pings: List[asyncio.Task] = []
+        self.lookup_cache = TTLCache(LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+    
+    def _load_routing_snapshot(self) -> List[Tuple[str, int]]:
+        """Carga los contactos guardados en la última parada del nodo"""
+        if not os.path.exists(self.routing_snapshot_path):
+            return []
+        try:
+            with open(self.routing_snapshot_path) as snapshot_file:
+                return [(host, port) for _, host, port in json.load(snapshot_file)]
+        except Exception as e:
+            logger.warning(f"No se pudo cargar la tabla de rutas guardada: {e}")
+            return []
+    
+    def _save_routing_snapshot(self):
+        """Guarda los contactos de la tabla de rutas como [(id_hex, host, puerto), ...]"""
+        if not self.server.protocol:
+            return
+        contacts = [
+            (node.id.hex(), node.ip, node.port)
+            for bucket in self.server.protocol.router.buckets
+            for node in bucket.get_nodes()
+        ]
+        try:
+            with open(self.routing_snapshot_path, 'w') as snapshot_file:
+                json.dump(contacts, snapshot_file)
+        except Exception as e:
+            logger.warning(f"No se pudo guardar la tabla de rutas: {e}")
+    
+    async def _ping_saved_contact(self, addr: Tuple[str, int]):
+        """Hace ping a un contacto guardado; None si no responde a tiempo"""
+        try:
+            return await asyncio.wait_for(
+                self.server.bootstrap_node(addr), SNAPSHOT_BOOTSTRAP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            return None
+    
+    async def _ping_saved_contacts(self, wait: bool) -> List:
+        """Hace ping a cada contacto guardado y devuelve los primeros que responden.
+        
+        Con wait espera hasta que responda alguno o hasta que fallen todos;
+        sin él no espera. Los pings pendientes siguen en segundo plano: si
+        responden más tarde, el protocolo añade el nodo a la tabla de rutas.
+        """
+        saved_nodes = self._load_routing_snapshot()
+        self.snapshot_pings = [
+            asyncio.ensure_future(self._ping_saved_contact(addr)) for addr in saved_nodes
+        ]
+        pending = set(self.snapshot_pings) if wait else set()
+        responders = []
+        while pending and not responders:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            responders.extend(ping.result() for ping in done if ping.result())
+        
+        if wait and saved_nodes and not responders:
+            logger.info("Los contactos guardados no respondieron a tiempo")
+        return responders
     
     async def start(self, bootstrap_nodes: List[Tuple[str, int]] = None):
         """Inicia el nodo P2P"""
@@ -113,7 +503,20 @@ class P2PNode:
             await self.server.listen(self.port)
             logger.info(f"Nodo {self.node_id} escuchando en puerto {self.port}")
             
-            if bootstrap_nodes:
+            # Se intenta primero con los contactos de la ejecución anterior y
+            # se arranca desde los primeros que respondan; los nodos bootstrap
+            # solo se usan si no responde ninguno a tiempo. Sin nodos bootstrap
+            # no hay alternativa, así que no se espera a los contactos
+            responders = await self._ping_saved_contacts(wait=bool(bootstrap_nodes))
+            
+            if responders:
+                spider = NodeSpiderCrawl(
+                    self.server.protocol, self.server.node, responders,
+                    self.server.ksize, self.server.alpha
+                )
+                await spider.find()
+                logger.info(f"Conectado a {len(responders)} contactos guardados")
+            elif bootstrap_nodes:
                 await self.server.bootstrap(bootstrap_nodes)
                 logger.info(f"Conectado a nodos bootstrap: {bootstrap_nodes}")
             
@@ -132,27 +535,36 @@ class P2PNode:
     async def stop(self):
         """Detiene el nodo P2P"""
         self.running = False
+        for ping in self.snapshot_pings:
+            ping.cancel()
+        self._save_routing_snapshot()
         self.server.stop()
         if self.tcp_server:
             self.tcp_server.close()
             await self.tcp_server.wait_closed()
+        self.disk_executor.shutdown(wait=False)
         logger.info(f"Nodo {self.node_id} detenido")
     
     async def handle_fragment_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """Maneja solicitudes de fragmentos de otros nodos"""
         try:
-            data = await reader.read(1024)
-            fragment_hash = data.decode().strip()
-            
-            if fragment_hash in self.stored_fragments:
-                fragment = self.stored_fragments[fragment_hash]
-                writer.write(fragment.data)
-                await writer.drain()
-                logger.info(f"Fragmento {fragment_hash[:8]} enviado a peer")
-            else:
-                writer.write(b"")
-                await writer.drain()
-                logger.warning(f"Fragmento {fragment_hash[:8]} no encontrado")
+            # Una misma conexión puede pedir varios fragmentos seguidos
+            while True:
+                try:
+                    fragment_hash = await reader.readexactly(HASH_SIZE)
+                except asyncio.IncompleteReadError:
+                    break
+                
+                if fragment_hash in self.stored_fragments:
+                    fragment = self.stored_fragments[fragment_hash]
+                    writer.write(FRAME_HEADER.pack(len(fragment.data), fragment.compressed))
+                    writer.write(fragment.data)
+                    await writer.drain()
+                    logger.info(f"Fragmento {fragment_hash[:4].hex()} enviado a peer")
+                else:
+                    writer.write(FRAME_HEADER.pack(0, False))
+                    await writer.drain()
+                    logger.warning(f"Fragmento {fragment_hash[:4].hex()} no encontrado")
                 
         except Exception as e:
             logger.error(f"Error manejando solicitud de fragmento: {e}")
@@ -160,14 +572,31 @@ class P2PNode:
             writer.close()
             await writer.wait_closed()
     
+    async def _publish_fragment(self, fragment: Fragment, fragment_info: Dict, semaphore: asyncio.Semaphore):
+        """Registra un fragmento en la DHT y libera su turno en el semáforo"""
+        try:
+            fragment_info_blob = _pack_fragment_info(fragment_info)
+            await self.server.set(fragment.hash, fragment_info_blob)
+            self.lookup_cache.set(fragment.hash, fragment_info_blob)
+            logger.info(f"Fragmento {fragment.index} registrado: {fragment.hash[:4].hex()}...")
+        finally:
+            semaphore.release()
+    
     async def store_file(self, filepath: str) -> bool:
         """Almacena un archivo fragmentándolo en la red"""
         try:
+            loop = asyncio.get_running_loop()
             fragments = self.fragment_manager.fragment_file(filepath)
             filename = os.path.basename(filepath)
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_STORES)
             
             fragment_hashes = []
-            for fragment in fragments:
+            publish_tasks = []
+            file_size = 0
+            # La lectura y el hash de cada fragmento se hacen en un hilo de disco,
+            # solapándose con las publicaciones en la DHT aún pendientes
+            while (fragment := await loop.run_in_executor(self.disk_executor, next, fragments, None)) is not None:
+                file_size += fragment.size
                 self.stored_fragments[fragment.hash] = fragment
                 fragment_hashes.append(fragment.hash)
                 
@@ -180,30 +609,45 @@ class P2PNode:
                     'size': fragment.size
                 }
                 
-                await self.server.set(fragment.hash, json.dumps(fragment_info))
-                logger.info(f"Fragmento {fragment.index} registrado: {fragment.hash[:8]}...")
+                await semaphore.acquire()
+                publish_tasks.append(asyncio.create_task(
+                    self._publish_fragment(fragment, fragment_info, semaphore)
+                ))
+            
+            await asyncio.gather(*publish_tasks)
             
             self.file_registry[filename] = fragment_hashes
             file_info = {
                 'filename': filename,
-                'fragment_hashes': fragment_hashes,
-                'total_fragments': len(fragments),
-                'file_size': sum(f.size for f in fragments),
+                'fragment_hashes': [h.hex() for h in fragment_hashes],
+                'total_fragments': len(fragment_hashes),
+                'file_size': file_size,
                 'node_id': self.node_id
             }
             
-            await self.server.set(f"file:{filename}", json.dumps(file_info))
-            logger.info(f"Archivo {filename} almacenado con {len(fragments)} fragmentos")
+            file_info_str = json.dumps(file_info)
+            await self.server.set(f"file:{filename}", file_info_str)
+            self.lookup_cache.set(f"file:{filename}", file_info_str)
+            logger.info(f"Archivo {filename} almacenado con {len(fragment_hashes)} fragmentos")
             return True
             
         except Exception as e:
             logger.error(f"Error almacenando archivo {filepath}: {e}")
             return False
     
+    async def _cached_get(self, key):
+        """Lee un valor de la DHT, reutilizando lecturas recientes de la misma clave"""
+        value = self.lookup_cache.get(key)
+        if value is None:
+            value = await self.server.get(key)
+            if value is not None:
+                self.lookup_cache.set(key, value)
+        return value
+    
     async def search_file(self, filename: str) -> Optional[Dict]:
         """Busca un archivo en la red P2P"""
         try:
-            file_info_str = await self.server.get(f"file:{filename}")
+            file_info_str = await self._cached_get(f"file:{filename}")
             if file_info_str:
                 file_info = json.loads(file_info_str)
                 logger.info(f"Archivo encontrado: {filename}")
@@ -215,43 +659,96 @@ class P2PNode:
             logger.error(f"Error buscando archivo {filename}: {e}")
             return None
     
-    async def download_fragment(self, fragment_hash: str, peer_address: Tuple[str, int]) -> Optional[Fragment]:
-        """Descarga un fragmento específico de un peer"""
+    async def _lookup_fragment_info(self, fragment_hash: bytes, semaphore: asyncio.Semaphore) -> Optional[bytes]:
+        """Consulta en la DHT los metadatos de un fragmento respetando el límite de concurrencia"""
+        cached = self.lookup_cache.get(fragment_hash)
+        if cached is not None:
+            return cached
+        async with semaphore:
+            return await self._cached_get(fragment_hash)
+    
+    async def _download_batch_from_peer(self, peer_address: Tuple[str, int],
+                                        batch: List[Tuple[bytes, Dict]], queue: asyncio.Queue):
+        """Descarga varios fragmentos de un mismo peer sobre una única conexión.
+        
+        Cada fragmento (o None si falla) se entrega en queue; si la cola está
+        llena se deja de leer del socket hasta que el consumidor avance.
+        """
+        delivered = 0
+        cancelled = False
+        writer = None
         try:
-            # Obtener metadatos del fragmento desde la DHT
-            fragment_info_str = await self.server.get(fragment_hash)
-            if not fragment_info_str:
-                logger.warning(f"Metadatos no encontrados para fragmento: {fragment_hash[:8]}")
-                return None
-            fragment_info = json.loads(fragment_info_str)
-            
-            reader, writer = await asyncio.open_connection(peer_address[0], peer_address[1])
-            writer.write(fragment_hash.encode())
-            await writer.drain()
-            
-            data = await reader.read()
-            if data:
-                fragment = Fragment(
-                    hash=fragment_hash,
-                    size=len(data),
-                    index=fragment_info['index'],
-                    total_fragments=fragment_info['total_fragments'],
-                    filename=fragment_info['filename'],
-                    data=data
-                )
-                logger.info(f"Fragmento descargado: {fragment_hash[:8]} desde {peer_address}")
-                return fragment
-            else:
-                logger.warning(f"Fragmento no disponible: {fragment_hash[:8]} en {peer_address}")
-                return None
+            async with self.transfer_semaphore:
+                reader, writer = await asyncio.open_connection(peer_address[0], peer_address[1])
+                # Todas las solicitudes se envían seguidas y las respuestas
+                # se leen en el mismo orden
+                writer.write(b"".join(fragment_hash for fragment_hash, _ in batch))
+                await writer.drain()
+                
+                for fragment_hash, fragment_info in batch:
+                    length, compressed = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                    data = await reader.readexactly(length)
+                    
+                    if data:
+                        # Los datos se conservan tal como llegan y se descomprimen al escribirlos
+                        fragment = Fragment(
+                            hash=fragment_hash,
+                            size=fragment_info['size'],
+                            index=fragment_info['index'],
+                            total_fragments=fragment_info['total_fragments'],
+                            filename=fragment_info['filename'],
+                            data=data,
+                            compressed=compressed
+                        )
+                        logger.info(f"Fragmento descargado: {fragment_hash[:4].hex()} desde {peer_address}")
+                    else:
+                        fragment = None
+                        logger.warning(f"Fragmento no disponible: {fragment_hash[:4].hex()} en {peer_address}")
+                    
+                    await queue.put(fragment)
+                    delivered += 1
                 
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
         except Exception as e:
-            logger.error(f"Error descargando fragmento {fragment_hash}: {e}")
-            return None
+            logger.error(f"Error descargando fragmentos desde {peer_address}: {e}")
         finally:
-            if 'writer' in locals():
+            if writer:
                 writer.close()
-                await writer.wait_closed()
+                try:
+                    await writer.wait_closed()
+                except Exception as e:
+                    logger.warning(f"Error cerrando conexión con {peer_address}: {e}")
+            # Los fragmentos no entregados se marcan como fallidos para que el
+            # consumidor no los espere; si la descarga se canceló nadie los lee
+            if not cancelled:
+                for _ in range(len(batch) - delivered):
+                    await queue.put(None)
+    
+    async def _signal_downloads_finished(self, peer_tasks: List[asyncio.Task], queue: asyncio.Queue):
+        """Encola _DOWNLOADS_FINISHED cuando terminan todas las descargas, fallen o no"""
+        await asyncio.gather(*peer_tasks, return_exceptions=True)
+        await queue.put(_DOWNLOADS_FINISHED)
+    
+    async def download_fragment(self, fragment_hash: bytes, peer_address: Tuple[str, int],
+                                fragment_info: Optional[Dict] = None) -> Optional[Fragment]:
+        """Descarga un fragmento específico de un peer"""
+        if fragment_info is None:
+            # Obtener metadatos del fragmento desde la DHT
+            try:
+                fragment_info_blob = await self._cached_get(fragment_hash)
+                if not fragment_info_blob:
+                    logger.warning(f"Metadatos no encontrados para fragmento: {fragment_hash[:4].hex()}")
+                    return None
+                fragment_info = _unpack_fragment_info(fragment_info_blob)
+            except Exception as e:
+                logger.error(f"Error descargando fragmento {fragment_hash.hex()}: {e}")
+                return None
+        
+        queue: asyncio.Queue = asyncio.Queue()
+        await self._download_batch_from_peer(peer_address, [(fragment_hash, fragment_info)], queue)
+        return queue.get_nowait()
     
     async def download_file(self, filename: str, output_path: str) -> bool:
         """Descarga un archivo completo de la red P2P"""
@@ -261,44 +758,108 @@ class P2PNode:
                 logger.error(f"Archivo no encontrado: {filename}")
                 return False
             
-            fragment_hashes = file_info['fragment_hashes']
+            fragment_hashes = [bytes.fromhex(h) for h in file_info['fragment_hashes']]
             total_fragments = file_info['total_fragments']
             
             logger.info(f"Iniciando descarga de {filename} ({total_fragments} fragmentos)")
             
-            download_tasks = []
-            fragment_peers = {}
+            # Un mismo contenido puede aparecer en varias posiciones del archivo
+            # (bloques repetidos o de ceros): se pide una sola vez y se escribe
+            # en todas ellas. Las posiciones salen de fragment_hashes, no del
+            # índice publicado en la DHT, que es el mismo para todas las copias
+            positions: Dict[bytes, List[int]] = defaultdict(list)
+            for position, fragment_hash in enumerate(fragment_hashes):
+                positions[fragment_hash].append(position)
             
-            for fragment_hash in fragment_hashes:
-                fragment_info_str = await self.server.get(fragment_hash)
-                if fragment_info_str:
-                    fragment_info = json.loads(fragment_info_str)
-                    peer_address = tuple(fragment_info['node_address'])
-                    fragment_peers[fragment_hash] = peer_address
-                    task = self.download_fragment(fragment_hash, peer_address)
-                    download_tasks.append(task)
+            peer_batches: Dict[Tuple[str, int], List[Tuple[bytes, Dict]]] = defaultdict(list)
+            
+            # Todas las consultas de metadatos se lanzan a la vez, limitadas
+            # por el parámetro de paralelismo (alpha) de Kademlia
+            lookup_semaphore = asyncio.Semaphore(self.server.alpha)
+            fragment_infos = await asyncio.gather(*(
+                self._lookup_fragment_info(fragment_hash, lookup_semaphore)
+                for fragment_hash in positions
+            ))
+            
+            fragment_size = 0
+            for fragment_hash, fragment_info_blob in zip(positions, fragment_infos):
+                if fragment_info_blob:
+                    fragment_info = _unpack_fragment_info(fragment_info_blob)
+                    peer_batches[fragment_info['node_address']].append((fragment_hash, fragment_info))
+                    # Todos los fragmentos salvo el último miden lo mismo que el primero
+                    if fragment_hash == fragment_hashes[0]:
+                        fragment_size = fragment_info['size']
                 else:
-                    logger.error(f"No se pudo obtener info del fragmento: {fragment_hash[:8]}...")
+                    logger.error(f"No se pudo obtener info del fragmento: {fragment_hash[:4].hex()}...")
                     return False
             
-            start_time = time.time()
-            fragments = await asyncio.gather(*download_tasks, return_exceptions=True)
-            download_time = time.time() - start_time
+            # Se descarga a un archivo temporal junto al destino, que solo
+            # reemplaza a output_path si la descarga se completa
+            output_dir = os.path.dirname(os.path.abspath(output_path))
+            fd, temp_path = tempfile.mkstemp(
+                dir=output_dir, prefix=f".{os.path.basename(output_path)}.", suffix=".part"
+            )
+            completed = False
             
-            valid_fragments = [f for f in fragments if isinstance(f, Fragment)]
+            # Una sola conexión por peer, por la que se piden todos sus fragmentos.
+            # Cada fragmento se escribe en su posición en cuanto llega, así que la
+            # memoria está acotada por la cola y no por el tamaño del archivo
+            start_ns = time.perf_counter_ns()
+            loop = asyncio.get_running_loop()
+            queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_IN_FLIGHT_FRAGMENTS)
+            peer_tasks = [
+                asyncio.create_task(self._download_batch_from_peer(peer_address, batch, queue))
+                for peer_address, batch in peer_batches.items()
+            ]
+            # El consumidor termina con la marca de fin, no contando fragmentos:
+            # un peer que muera sin entregar los suyos no puede bloquearlo
+            finished_task = asyncio.create_task(self._signal_downloads_finished(peer_tasks, queue))
             
-            if len(valid_fragments) != total_fragments:
-                logger.error(f"Descarga incompleta: {len(valid_fragments)}/{total_fragments}")
-                return False
-            
-            success = self.fragment_manager.assemble_file(valid_fragments, output_path)
-            if success:
-                total_size = sum(f.size for f in valid_fragments)
-                speed = total_size / download_time / 1024 / 1024
-                logger.info(f"Descarga completada: {filename}")
-                logger.info(f"Tiempo: {download_time:.2f}s, Velocidad: {speed:.2f} MB/s")
+            written_positions = 0
+            total_bytes = 0
+            try:
+                while (fragment := await queue.get()) is not _DOWNLOADS_FINISHED:
+                    if fragment is None:
+                        continue
+                    offsets = [position * fragment_size for position in positions[fragment.hash]]
+                    try:
+                        # La descompresión y la escritura se hacen en un hilo
+                        # para no bloquear el bucle de eventos
+                        await loop.run_in_executor(
+                            self.disk_executor, _write_fragment_at, fd, fragment, offsets
+                        )
+                    except ValueError as e:
+                        logger.error(f"Fragmento descartado: {e}")
+                        continue
+                    written_positions += len(offsets)
+                    total_bytes += fragment.size * len(offsets)
+                
+                elapsed_ns = time.perf_counter_ns() - start_ns
+                
+                if written_positions != total_fragments:
+                    logger.error(f"Descarga incompleta: {written_positions}/{total_fragments}")
+                    return False
+                
+                os.close(fd)
+                fd = None
+                # mkstemp crea el temporal con permisos 0600
+                os.chmod(temp_path, _output_file_mode(output_path))
+                os.replace(temp_path, output_path)
+                completed = True
+            finally:
+                for task in [*peer_tasks, finished_task]:
+                    task.cancel()
+                if fd is not None:
+                    os.close(fd)
+                if not completed:
+                    os.remove(temp_path)
             
-            return success
+            download_time = elapsed_ns / 1e9
+            speed = total_bytes * 1e9 / (max(elapsed_ns, 1) * 1024 * 1024)
+            logger.info(f"Archivo ensamblado exitosamente en {output_path}")
+            logger.info(f"Descarga completada: {filename}")
+            logger.info(f"Tiempo: {download_time:.2f}s, Velocidad: {speed:.2f} MB/s")
+            return True
             
         except Exception as e:
             logger.error(f"Error descargando archivo {filename}: {e}")